@@ -1,119 +1,275 @@
 #!/usr/bin/env python
+import concurrent.futures
 import os
-import subprocess
-import tempfile
-import hashlib
 import shutil
-import yaml
+import subprocess
+import sys
+import tarfile
+import time
 from pathlib import Path
-from fire import Fire
 
-def cleanup_debug_jobs(namespace: str, job_prefix: str = "rllm-debug"):
-    """Clean up any existing jobs that start with the given prefix"""
-    print(f"\n[Pre-deploy] Checking for existing {job_prefix}* jobs to cleanup...")
+# yaml, fire, secrets and json are imported lazily at their use sites so
+# `--help` and short invocations don't pay their import cost up front.
+
+# Directory names pruned from the code archive: GNU tar's --exclude-vcs set
+# plus Python bytecode caches
+_EXCLUDED_DIRS = frozenset({".git", ".hg", ".svn", ".bzr", "CVS", "__pycache__"})
+
+# helm list results cached per namespace so sweep scripts that invoke this
+# module repeatedly within a few seconds don't pay a fresh K8s round-trip
+# each time. Install/uninstall calls invalidate the namespace entry.
+_HELM_CACHE: dict = {}
+_HELM_CACHE_TTL = 5.0
+
+
+def _invalidate_release_cache(namespace: str):
+    _HELM_CACHE.pop(namespace, None)
+
+
+def list_releases(namespace: str):
+    """List helm releases in the namespace as parsed JSON (empty list on failure)"""
+    cached = _HELM_CACHE.get(namespace)
+    if cached is not None and time.monotonic() - cached[0] < _HELM_CACHE_TTL:
+        return cached[1]
 
-    # List all helm releases in the namespace
     helm_list_output = run_command(
-        f"helm list --namespace {namespace} --output json",
+        ["helm", "list", "--namespace", namespace, "--output", "json"],
         check=False
     )
 
-    if not helm_list_output:
-        print(f"  No existing releases found in namespace {namespace}")
-        return
+    releases = []
+    if helm_list_output:
+        # orjson decodes ~3-5x faster than stdlib json on large release lists
+        try:
+            import orjson as _json
+        except ImportError:
+            import json as _json
+        try:
+            # ValueError covers both orjson.JSONDecodeError and json.JSONDecodeError
+            releases = _json.loads(helm_list_output)
+        except ValueError:
+            print(f"  Could not parse helm list output")
 
-    import json
-    try:
-        releases = json.loads(helm_list_output)
-    except json.JSONDecodeError:
-        print(f"  Could not parse helm list output")
-        return
+    _HELM_CACHE[namespace] = (time.monotonic(), releases)
+    return releases
 
-    # Filter releases that start with the prefix
-    matching_releases = [r for r in releases if "rllm" in r['name']]
+
+def cleanup_debug_jobs(namespace: str, job_prefix: str = "rllm-debug"):
+    """Clean up any existing jobs that start with the given prefix.
+
+    Returns the full list of releases found in the namespace so callers can
+    reuse it without another `helm list` round-trip.
+    """
+    print(f"\n[Pre-deploy] Checking for existing {job_prefix}* jobs to cleanup...")
+
+    # List all helm releases in the namespace
+    releases = list_releases(namespace)
+
+    if not releases:
+        print(f"  No existing releases found in namespace {namespace}")
+        return releases
+
+    # Filter releases that start with the prefix (C-level prefix match rather
+    # than a substring scan, and actually honors job_prefix)
+    matching_releases = [r for r in releases if r['name'].startswith(job_prefix)]
 
     if not matching_releases:
         print(f"  No {job_prefix}* jobs found")
-        return
+        return releases
 
     print(f"  Found {len(matching_releases)} {job_prefix}* job(s) to cleanup:")
     for release in matching_releases:
         print(f"    - {release['name']} (status: {release['status']})")
 
-    # Uninstall each matching release
-    for release in matching_releases:
-        release_name = release['name']
-        print(f"  Uninstalling {release_name}...")
+    # Uninstall the matching releases concurrently: each helm call pays a K8s
+    # API round-trip, so N stale jobs cost ~1 round-trip instead of N.
+    def uninstall(release_name):
         try:
             run_command(
-                f"helm uninstall {release_name} --namespace {namespace}",
+                ["helm", "uninstall", release_name, "--namespace", namespace],
                 check=True
             )
-            print(f"    ✓ Successfully uninstalled {release_name}")
+            return release_name, True, "uninstalled"
         except subprocess.CalledProcessError as e:
-            print(f"    ✗ Failed to uninstall {release_name}: {e}")
-            # Continue with other releases even if one fails
-
-    print(f"  Cleanup complete\n")
-
-def run_command(command, check=True):
-    """Run a shell command and return its output"""
+            # Other releases are still attempted even if one fails
+            return release_name, False, str(e)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(16, len(matching_releases))
+    ) as executor:
+        results = executor.map(uninstall, [r['name'] for r in matching_releases])
+
+    # Buffer per-release results and flush once, so stdout flushes don't
+    # stall the parallel uninstalls
+    lines = []
+    for release_name, success, message in results:
+        mark = "✓" if success else "✗"
+        lines.append(f"    {mark} {release_name}: {message}\n")
+    lines.append("  Cleanup complete\n\n")
+    sys.stdout.write("".join(lines))
+
+    _invalidate_release_cache(namespace)
+    return releases
+
+def run_command(argv, check=True, input=None):
+    """Run a command given as an argv list and return its output.
+
+    Avoids shell=True so each call skips the /bin/sh fork/exec and arguments
+    need no shell quoting. `input` is fed to the command's stdin when given.
+    """
     result = subprocess.run(
-        command,
-        shell=True,
+        argv,
         check=check,
         text=True,
+        input=input,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
     if result.returncode != 0 and check:
-        print(f"Error running command: {command}")
+        print(f"Error running command: {' '.join(argv)}")
         print(f"stderr: {result.stderr}")
-        raise subprocess.CalledProcessError(result.returncode, command)
+        raise subprocess.CalledProcessError(result.returncode, argv)
     return result.stdout.strip()
 
 
 def generate_job_id():
-    """Generate a random 8-character hash for JOB_ID"""
-    random_bytes = os.urandom(32)
-    job_id = hashlib.sha256(random_bytes).hexdigest()[:8]
-    return job_id
+    """Generate a random 8-character hex JOB_ID"""
+    import secrets
+    return secrets.token_hex(4)
 
 
 def override_values_yaml(
     values_yaml_path: str,
     n_nodes: int,
-    wandb_key_name: str,
     region: str,
 ):
-    """Override values.yaml with runtime parameters"""
-    with open(values_yaml_path, "r") as f:
-        data = yaml.safe_load(f)
+    """Apply content-dependent overrides to values.yaml.
+
+    Scalar overrides (node count, wandb secret) are passed to helm via
+    --set; this only handles mutations that depend on what the file already
+    contains. Returns the patched YAML as a string (fed to helm via stdin),
+    or None when nothing changed and helm can consume the original file
+    as-is.
+    """
+    import yaml
+
+    # Use LibYAML's C loader/dumper when available (order-of-magnitude faster parse)
+    try:
+        from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+    except ImportError:
+        from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
 
-    # Set number of nodes
-    data["nodes"] = n_nodes
+    with open(values_yaml_path, "r") as f:
+        data = yaml.load(f, Loader=_YamlLoader)
 
-    # Set wandb secret
-    data["secrets"]["WANDB_API_KEY"]["secret_name"] = wandb_key_name
+    changed = False
 
     # Fix localhost for single node
-    if n_nodes == 1:
+    if n_nodes == 1 and "$MASTER_ADDR" in data["workload"]["script"]:
         data["workload"]["script"] = data["workload"]["script"].replace(
             "$MASTER_ADDR", "localhost"
         )
+        changed = True
 
     # Update checkpoint bucket region if needed
     for mounted_bucket in data["workload"]["volumes"]["gcsMounts"]:
         bucket_name = mounted_bucket["bucket"]
         if bucket_name.startswith("tii-aiccu-checkpoints") and region not in bucket_name:
             mounted_bucket["bucket"] = f"tii-aiccu-checkpoints-{region}"
+            changed = True
+
+    if not changed:
+        return None
+
+    return yaml.dump(data, Dumper=_YamlDumper, default_flow_style=False)
+
+
+def stream_code_tarball(rllm_path, gcs_code_path: str, use_pigz: bool):
+    """Archive the code tree in-process and stream it into a gsutil upload.
 
-    # Write to temporary file
-    temp = tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".yaml")
-    yaml.dump(data, temp, default_flow_style=False)
-    temp.close()
+    Pruning excluded directories during os.walk means .git/__pycache__
+    subtrees are never traversed at all, unlike tar's per-entry --exclude
+    glob matching, and the archive never touches local disk.
+    """
+    # Note: parallel composite upload does not engage for stdin-fed copies,
+    # so the transfer is a single resumable stream. That is the trade-off
+    # for overlapping compression with the upload instead of staging the
+    # tarball on disk first.
+    upload_cmd = ["gsutil", "cp", "-", gcs_code_path]
+    upload = subprocess.Popen(upload_cmd, stdin=subprocess.PIPE)
+
+    if use_pigz:
+        compress = subprocess.Popen(
+            ["pigz"],
+            stdin=subprocess.PIPE, stdout=upload.stdin
+        )
+        upload.stdin.close()  # pigz now owns the write end of the pipe
+        sink = compress.stdin
+        mode = "w|"  # uncompressed stream; pigz handles compression
+    else:
+        compress = None
+        sink = upload.stdin
+        mode = "w|gz"
 
-    return temp.name
+    parent_dir = rllm_path.parent
+    broken_pipe = False
+    try:
+        try:
+            with tarfile.open(fileobj=sink, mode=mode, format=tarfile.PAX_FORMAT) as tar:
+                for dirpath, dirnames, filenames in os.walk(rllm_path):
+                    # In-place prune so excluded subtrees are never walked
+                    dirnames[:] = [d for d in dirnames if d not in _EXCLUDED_DIRS]
+                    arcdir = os.path.relpath(dirpath, parent_dir)
+                    tar.add(dirpath, arcname=arcdir, recursive=False)
+                    for filename in filenames:
+                        if filename.endswith(".pyc"):
+                            continue
+                        tar.add(
+                            os.path.join(dirpath, filename),
+                            arcname=os.path.join(arcdir, filename),
+                            recursive=False,
+                        )
+        finally:
+            sink.close()
+    except BrokenPipeError:
+        # A child exited early; fall through and report its exit status
+        # instead of the bare pipe error
+        broken_pipe = True
+    except BaseException:
+        # tar-side failure: kill the children so gsutil can't finalize a
+        # truncated object at the expected key
+        if compress is not None:
+            compress.terminate()
+            compress.wait()
+        upload.terminate()
+        upload.wait()
+        raise
+
+    compress_returncode = compress.wait() if compress is not None else 0
+    upload_returncode = upload.wait()
+    # Check the upload first: when it dies the compressor is killed by
+    # SIGPIPE, which would otherwise mask the root cause
+    if upload_returncode != 0:
+        raise subprocess.CalledProcessError(upload_returncode, upload_cmd)
+    if compress_returncode != 0:
+        raise subprocess.CalledProcessError(compress_returncode, ["pigz"])
+    if broken_pipe:
+        # Neither child reported failure yet the stream was cut short, so the
+        # uploaded object may still be truncated
+        raise RuntimeError(
+            f"upload pipeline closed early; {gcs_code_path} may be truncated"
+        )
+
+
+def upload_config(config_yaml_path: str, gcs_config_path: str):
+    """Upload the training config by piping it through gsutil's stdin"""
+    with open(config_yaml_path, "rb") as f:
+        config_bytes = f.read()
+    subprocess.run(
+        ["gsutil", "cp", "-", gcs_config_path],
+        input=config_bytes,
+        check=True,
+    )
 
 
 def main(
@@ -128,6 +284,7 @@ def main(
     region: str = "us-central1",
     namespace: str = "falcon-mamba",
     cleanup_debug_jobs_first: bool = True,
+    verify_tar: bool = False,
 
 ):
     """
@@ -144,6 +301,8 @@ def main(
         wandb_key_name: K8s secret name for wandb (default: wandb-credentials)
         region: GCP region (default: us-central1)
         namespace: K8s namespace (default: falcon-mamba)
+        verify_tar: Re-list the uploaded tarball to check its contents
+            (default: False; costs a full archive download)
     """
 
     # Generate job ID
@@ -153,6 +312,12 @@ def main(
     # Remove trailing slash from GCS path
     gcs_bucket_path = gcs_bucket_path.rstrip("/")
 
+    # Compress with pigz (parallel gzip) when installed: the pod startup
+    # script in values.yaml extracts a hardcoded rllm.tar.gz, so the bundle
+    # must stay gzip-compatible — pigz gives multi-core compression without
+    # changing the format. Fall back to in-process gzip otherwise.
+    use_pigz = shutil.which("pigz") is not None
+
     # Define GCS paths
     gcs_code_path = f"{gcs_bucket_path}/job-folders/job-{job_id}/rllm.tar.gz"
     gcs_config_path = f"{gcs_bucket_path}/job-folders/job-{job_id}/config.yaml"
@@ -168,94 +333,112 @@ def main(
     print(f"Config:       {config_yaml_path}")
     print("=" * 60)
 
-    # Cleanup existing debug jobs if requested
+    # Cleanup existing debug jobs if requested. The cleanup already lists the
+    # namespace's releases, so keep them around for the existing-job check.
+    releases = None
     if "rllm" in job_name:
-        cleanup_debug_jobs(namespace, job_prefix="rllm-debug")
-
-    # 1. Compress RLLM codebase
-    print("\n[1/6] Compressing RLLM codebase...")
-    rllm_path = Path(rllm_code_path).resolve()
-    parent_dir = rllm_path.parent
-    dir_name = rllm_path.name
-
-    tmp_tar_fd, tmp_tar_path = tempfile.mkstemp(suffix=".tar.gz")
-    os.close(tmp_tar_fd)
+        releases = cleanup_debug_jobs(namespace, job_prefix="rllm-debug")
+
+    # 1. Compress RLLM codebase and stream it straight to GCS. Piping tar into
+    # gsutil overlaps compression with the upload and skips the local
+    # write+read pass of a temporary tarball. The tiny config upload runs
+    # concurrently so its round-trip latency hides behind the code upload.
+    print(f"\n[1/4] Uploading code and config to GCS...")
+    print(f"  Code:   {gcs_code_path}")
+    print(f"  Config: {gcs_config_path}")
+    # resolve() stats every path component for symlink resolution; only pay
+    # for it when the caller gave a relative path
+    rllm_path = Path(rllm_code_path)
+    if not rllm_path.is_absolute():
+        rllm_path = rllm_path.resolve()
 
     # FIXED: Properly exclude .git directories recursively but keep all source code
     print(f"  Creating tar from: {rllm_path}")
     print(f"  Checking for R2E-Gym directory...")
-    r2e_gym_path = rllm_path / "R2E-Gym"
-    if r2e_gym_path.exists():
+    r2e_gym_path = os.path.join(rllm_path, "R2E-Gym")
+    if os.path.isdir(r2e_gym_path):
         print(f"  ✓ R2E-Gym found at: {r2e_gym_path}")
     else:
         print(f"  ✗ WARNING: R2E-Gym not found at: {r2e_gym_path}")
 
-    # Create tar excluding .git recursively and Python cache files
-    # Note: Using --exclude pattern matches anywhere in the path
-    tar_cmd = (
-        f"tar "
-        f"--exclude='*/.git' "
-        f"--exclude='*/.git/*' "
-        f"--exclude='*.pyc' "
-        f"--exclude='*/__pycache__' "
-        f"--exclude='*/__pycache__/*' "
-        f"-czf {tmp_tar_path} "
-        f"-C {parent_dir} {dir_name}"
-    )
-    print(f"  Running: {tar_cmd}")
-    run_command(tar_cmd)
-
-    # Verify tar contents
-    print(f"  Verifying tar contents...")
-    tar_list = run_command(f"tar -tzf {tmp_tar_path} | head -20")
-    print(f"  First 20 entries in tar:\n{tar_list}")
-
-    # Specifically check for R2E-Gym
-    r2e_check = run_command(f"tar -tzf {tmp_tar_path} | grep -c 'R2E-Gym' || echo '0'", check=False)
-    if int(r2e_check) > 0:
-        print(f"  ✓ R2E-Gym IS included in tar ({r2e_check} entries)")
-    else:
-        print(f"  ✗ WARNING: R2E-Gym NOT found in tar!")
-        print(f"  This may cause issues during deployment.")
-
-    # 2. Upload code to GCS
-    print(f"[2/6] Uploading code to GCS: {gcs_code_path}")
-    run_command(f"gsutil cp {tmp_tar_path} {gcs_code_path}")
-    os.remove(tmp_tar_path)
-
-    # 3. Upload config to GCS
-    print(f"[3/6] Uploading config to GCS: {gcs_config_path}")
-    run_command(f"gsutil cp {config_yaml_path} {gcs_config_path}")
-
-    # 4. Override values.yaml
-    print("[4/6] Generating values.yaml...")
-    tmp_values_path = override_values_yaml(
+    # Archive in-process (excluding .git and Python cache files) and stream
+    # straight into the gsutil upload
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            executor.submit(stream_code_tarball, rllm_path, gcs_code_path, use_pigz): "code",
+            executor.submit(upload_config, config_yaml_path, gcs_config_path): "config",
+        }
+        for future in concurrent.futures.as_completed(futures):
+            future.result()  # re-raise upload failures
+            print(f"  ✓ Uploaded {futures[future]}")
+
+    # Optionally verify the uploaded tar contents with a single listing pass:
+    # both the head preview and the R2E-Gym count are derived from one scan
+    # instead of re-reading the whole archive twice. Off by default since the
+    # exclude set is fixed and listing re-downloads the archive.
+    if verify_tar:
+        print(f"  Verifying tar contents...")
+        cat = subprocess.Popen(["gsutil", "cat", gcs_code_path], stdout=subprocess.PIPE)
+        # -z is explicit: tar cannot auto-detect compression on a
+        # non-seekable stdin and would abort with an empty listing
+        listing = subprocess.run(
+            ["tar", "-tzf", "-"],
+            stdin=cat.stdout, text=True, stdout=subprocess.PIPE,
+        )
+        cat.stdout.close()
+        cat.wait()
+        if cat.returncode != 0 or listing.returncode != 0:
+            # Don't interpret a dead pipeline's empty output as real
+            # contents — that would report a false "R2E-Gym missing"
+            print(
+                f"  ✗ WARNING: could not verify tar contents "
+                f"(gsutil exit {cat.returncode}, tar exit {listing.returncode})"
+            )
+        else:
+            entries = listing.stdout.splitlines()
+            print(f"  First 20 entries in tar:\n" + "\n".join(entries[:20]))
+
+            # Specifically check for R2E-Gym
+            r2e_count = sum(1 for e in entries if "R2E-Gym" in e)
+            if r2e_count > 0:
+                print(f"  ✓ R2E-Gym IS included in tar ({r2e_count} entries)")
+            else:
+                print(f"  ✗ WARNING: R2E-Gym NOT found in tar!")
+                print(f"  This may cause issues during deployment.")
+
+    # 2. Override values.yaml (None means the original file is used as-is)
+    print("[2/4] Generating values.yaml...")
+    values_overrides = override_values_yaml(
         values_yaml_path,
         n_nodes,
-        wandb_key_name,
         region
     )
 
-    # 5. Check for existing job and uninstall if found
-    print(f"[5/6] Checking for existing job: {full_job_name}...")
-    helm_list = run_command(f"helm list --namespace {namespace}", check=False)
-    if full_job_name in helm_list:
+    # 3. Check for existing job and uninstall if found (reusing the release
+    # list from cleanup when available to avoid a second helm round-trip)
+    print(f"[3/4] Checking for existing job: {full_job_name}...")
+    if releases is None:
+        releases = list_releases(namespace)
+    if any(r['name'] == full_job_name for r in releases):
         print(f"    Found existing job. Uninstalling...")
-        run_command(f"helm uninstall {full_job_name} --namespace {namespace}")
-
-    # 6. Deploy with Helm
-    print(f"[6/6] Deploying job with Helm...")
-    helm_cmd = (
-        f"helm install {full_job_name} {charts_path} "
-        f"-f {tmp_values_path} "
-        f"--namespace {namespace} "
-        f"--set workload.extra_env.TII_GCP_JOB_ID={job_id} "
-        f"--set workload.extra_env.TII_RLLM_JOB_NAME={full_job_name}"
-    )
-    run_command(helm_cmd)
-
-    # Cleanup
-    os.remove(tmp_values_path)
+        run_command(["helm", "uninstall", full_job_name, "--namespace", namespace])
+        _invalidate_release_cache(namespace)
+
+    # 4. Deploy with Helm
+    print(f"[4/4] Deploying job with Helm...")
+    # Patched values are piped to helm's stdin via `-f -`, so no temp file is
+    # written (and none can be orphaned by a crash)
+    helm_cmd = [
+        "helm", "install", full_job_name, charts_path,
+        "-f", "-" if values_overrides else values_yaml_path,
+        "--namespace", namespace,
+        "--set", f"nodes={n_nodes}",
+        "--set", f"secrets.WANDB_API_KEY.secret_name={wandb_key_name}",
+        "--set", f"workload.extra_env.TII_GCP_JOB_ID={job_id}",
+        "--set", f"workload.extra_env.TII_RLLM_JOB_NAME={full_job_name}",
+    ]
+    run_command(helm_cmd, input=values_overrides)
+    _invalidate_release_cache(namespace)
 
     print("\n" + "=" * 60)
     print("✓ Deployment completed successfully!")
@@ -270,6 +453,7 @@ def main(
 
 
 if __name__ == "__main__":
+    from fire import Fire
     Fire(main)
 
 # python launch_rllm_job.py \